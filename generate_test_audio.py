@@ -3,8 +3,10 @@
 Generiert eine minimal gültige WAV-Datei zum Testen der Mistral API
 """
 
-import struct
 import sys
+import wave
+
+import numpy as np
 
 def generate_wav(filename='test-audio.wav', duration=3, sample_rate=16000):
     """Generiert eine WAV-Datei mit Stille"""
@@ -14,28 +16,12 @@ def generate_wav(filename='test-audio.wav', duration=3, sample_rate=16000):
     num_samples = sample_rate * duration
     data_size = num_samples * num_channels * (bits_per_sample // 8)
     
-    with open(filename, 'wb') as f:
-        # RIFF header
-        f.write(b'RIFF')
-        f.write(struct.pack('<I', 36 + data_size))
-        f.write(b'WAVE')
-        
-        # fmt subchunk
-        f.write(b'fmt ')
-        f.write(struct.pack('<I', 16))  # Subchunk size
-        f.write(struct.pack('<H', 1))   # Audio format (PCM)
-        f.write(struct.pack('<H', num_channels))
-        f.write(struct.pack('<I', sample_rate))
-        f.write(struct.pack('<I', sample_rate * num_channels * bits_per_sample // 8))
-        f.write(struct.pack('<H', num_channels * bits_per_sample // 8))
-        f.write(struct.pack('<H', bits_per_sample))
-        
-        # data subchunk
-        f.write(b'data')
-        f.write(struct.pack('<I', data_size))
-        
+    with wave.open(filename, 'wb') as w:
+        w.setnchannels(num_channels)
+        w.setsampwidth(bits_per_sample // 8)
+        w.setframerate(sample_rate)
         # Audio data (silence = zeros)
-        f.write(b'\x00' * data_size)
+        w.writeframes(np.zeros(num_samples, dtype=np.int16).tobytes())
     
     file_size = 44 + data_size
     print(f'✅ Generiert: {filename}')
@@ -8,27 +8,69 @@ Optimiert für minimale Latenz:
 - Präzisions-Modus: Volles WhisperX mit Alignment (Offline/Mitlesen)
 """
 
-from flask import Flask, request, jsonify
+import os
+
+# Allocator-Konfiguration muss vor dem ersten torch-Import gesetzt sein.
+# Expandable Segments wachsen in-place statt zu fragmentieren, damit
+# freigegebene Blöcke ohne empty_cache() wiederverwendet werden. Ab 80%
+# Auslastung gibt der Allocator ungenutzte Blöcke selbstständig zurück;
+# Blöcke über 512 MB werden nicht gesplittet.
+os.environ.setdefault(
+    "PYTORCH_CUDA_ALLOC_CONF",
+    "expandable_segments:True,garbage_collection_threshold:0.8,max_split_size_mb:512"
+)
+
+# Größerer PTX-JIT-Cache, damit nicht jeder Neustart die Kernel neu kompiliert (muss vor der
+# CUDA-Initialisierung gesetzt sein). Der Ablageort CUDA_CACHE_PATH kommt aus der Umgebung
+# (docker-compose: persistentes Volume), sonst gilt der Treiber-Standard ~/.nv/ComputeCache
+os.environ.setdefault("CUDA_CACHE_MAXSIZE", "2147483648")  # 2 GB
+# Gepackte int8-GEMMs in CTranslate2 (wirkt nur im CPU-Modus mit Intel MKL)
+os.environ.setdefault("CT2_USE_EXPERIMENTAL_PACKED_GEMM", "1")
+
+from flask import Flask, Response, request, jsonify, stream_with_context
 from flask_cors import CORS
 import whisperx
+import ctranslate2
+from faster_whisper import decode_audio
+from faster_whisper.tokenizer import Tokenizer
+import numpy as np
 import torch
-import gc
-import tempfile
-import os
+import functools
+import hashlib
+import io
+import json
 import time
-from pathlib import Path
 import logging
+import queue
+import struct
+import subprocess
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from dataclasses import dataclass, field
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# BatchedInferencePipeline gibt es erst ab faster-whisper 1.1
+try:
+    from faster_whisper import BatchedInferencePipeline
+except ImportError:
+    BatchedInferencePipeline = None
+
+# ONNX Runtime für das Alignment-Modell (optional, onnxruntime-gpu installieren)
+try:
+    import onnxruntime
+except ImportError:
+    onnxruntime = None
+
 app = Flask(__name__)
 CORS(app)
 
 # Retry-Konfiguration
 MAX_RETRIES = 3
-RETRY_WAIT_AFTER_ERROR = 60  # Sekunden zwischen Retries nach Fehler
-VRAM_CLEAR_WAIT = 30  # Sekunden warten nach VRAM-Clear vor Diktat
+RETRY_MAX_WAIT = 10  # Obergrenze (Sekunden) für exponentiellen Backoff zwischen Retries
+VRAM_CLEAR_THRESHOLD = 0.85  # Anteil reservierter VRAM, ab dem vor dem Diktat geleert wird
 
 # Retry-Log für Debugging
 RETRY_LOG = []
@@ -47,17 +89,27 @@ def log_retry_attempt(attempt: int, error: str, action: str):
         RETRY_LOG.pop(0)
     logger.warning(f"[RETRY LOG] Attempt {attempt}: {action} - Error: {error}")
 
+def is_transient_gpu_error(e: Exception) -> bool:
+    """Prüft, ob ein Fehler auf vorübergehenden GPU-Zustand hindeutet (OOM, CUDA-Fehler)."""
+    if isinstance(e, torch.cuda.OutOfMemoryError):
+        return True
+    return isinstance(e, RuntimeError) and "CUDA" in str(e)
+
+def is_driver_fault(e: Exception) -> bool:
+    """Prüft, ob ein Fehler auf einen Treiber-/Kontextfehler hindeutet, der ein Neuladen erfordert."""
+    if not isinstance(e, RuntimeError):
+        return False
+    message = str(e)
+    return "CUDA error" in message or "device-side assert" in message
+
 def clear_vram():
     """Löscht den VRAM und gibt GPU-Speicher frei."""
-    global MODEL_CACHE
-    
     logger.info("[VRAM CLEAR] Starting VRAM cleanup...")
     print_vram_usage("BEFORE_CLEAR")
     
     try:
-        # Garbage Collection
-        gc.collect()
-        
+        # Kein gc.collect(): Tensoren werden per Referenzzählung freigegeben,
+        # ein voller GC-Lauf über alle Python-Objekte bringt hier nichts
         if DEVICE == "cuda":
             # Synchronisiere CUDA
             torch.cuda.synchronize()
@@ -79,30 +131,31 @@ def clear_vram():
         logger.error(f"[VRAM CLEAR] ✗ Error during VRAM cleanup: {e}")
         return False
 
+def clear_vram_if_needed():
+    """Leert den VRAM nur bei echtem Speicherdruck (reserviert > VRAM_CLEAR_THRESHOLD)."""
+    if DEVICE != "cuda":
+        return False
+    
+    total = torch.cuda.get_device_properties(0).total_memory
+    usage = torch.cuda.memory_reserved() / total
+    if usage <= VRAM_CLEAR_THRESHOLD:
+        return False
+    
+    logger.info(f"[VRAM CLEAR] Reserved VRAM at {usage:.0%} (> {VRAM_CLEAR_THRESHOLD:.0%}), clearing...")
+    return clear_vram()
+
 def restart_whisper_models():
     """Startet die Whisper-Modelle neu (lädt sie erneut)."""
-    global MODEL_CACHE, model, model_a, metadata
-    
     logger.info("[RESTART] Starting Whisper model restart...")
     
     try:
-        # Modelle entladen
-        MODEL_CACHE["whisperx"] = None
-        MODEL_CACHE["faster_whisper"] = None
-        MODEL_CACHE["align_model"] = None
-        MODEL_CACHE["align_metadata"] = None
-        MODEL_CACHE["is_warmed_up"] = False
-        
-        # VRAM freigeben
-        clear_vram()
-        
-        # Modelle neu laden
-        load_models()
-        
-        # Aliase aktualisieren
-        model = MODEL_CACHE["whisperx"]
-        model_a = MODEL_CACHE["align_model"]
-        metadata = MODEL_CACHE["align_metadata"]
+        with LOAD_LOCK:
+            # Neue Modelle laden und STATE in einem Schritt tauschen; laufende Requests
+            # sehen so nie einen halb geleerten Zustand und arbeiten mit den alten zu Ende
+            _load_models_locked()
+            
+            # VRAM der alten Modelle freigeben, sobald keine Referenzen mehr bestehen
+            clear_vram()
         
         logger.info("[RESTART] ✓ Whisper models restarted successfully")
         return True
@@ -112,23 +165,105 @@ def restart_whisper_models():
 
 # WhisperX Modell-Konfiguration
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
-# Verwende int8 für TitanX Pascal und andere ältere GPUs (Pascal-Architektur)
-# int8 ist stabiler und schneller auf Pascal-GPUs als float16
-COMPUTE_TYPE = "int8"
+# int8 für TitanX Pascal und ältere GPUs (< sm_70) sowie CPU, dort stabiler und schneller als float16.
+# Ab Volta (sm_70+) int8_float16: Gewichte bleiben int8, Aktivierungs-GEMMs laufen auf Tensor Cores.
+# Override per WHISPER_COMPUTE_TYPE-Env (z.B. int8_bfloat16 auf Ampere+, float16).
+GPU_CAPABILITY = torch.cuda.get_device_capability(0) if DEVICE == "cuda" else (0, 0)
+COMPUTE_TYPE = os.environ.get("WHISPER_COMPUTE_TYPE") or ("int8_float16" if GPU_CAPABILITY[0] >= 7 else "int8")
 MODEL_NAME = os.environ.get("WHISPER_MODEL", "large-v2")
+
+# TF32 für die PyTorch-Anteile (wav2vec2-Alignment) ab Ampere; auf Pascal wirkungslos
+torch.backends.cuda.matmul.allow_tf32 = True
+torch.backends.cudnn.allow_tf32 = True
+torch.set_float32_matmul_precision("high")
+if DEVICE == "cuda" and GPU_CAPABILITY[0] < 8:
+    logger.info(f"GPU sm_{GPU_CAPABILITY[0]}{GPU_CAPABILITY[1]} has no TF32 support, TF32 flags are inert")
+
+# cuDNN-Autotuning pro Input-Shape. Da jedes Alignment-Segment eine andere Länge hat,
+# würde ohne feste Shapes ständig neu getunt, daher nur per CUDNN_BENCHMARK=true
+torch.backends.cudnn.benchmark = os.environ.get("CUDNN_BENCHMARK", "false").lower() == "true"
+
+# Optionale Obergrenze für den PyTorch-Allocator (Anteil des VRAM, z.B. 0.9)
+CUDA_MEMORY_FRACTION = os.environ.get("CUDA_MEMORY_FRACTION")
+if DEVICE == "cuda" and CUDA_MEMORY_FRACTION:
+    torch.cuda.set_per_process_memory_fraction(float(CUDA_MEMORY_FRACTION))
+
+# CTranslate2-Threads für CPU-Deployments: CT2_INTER parallele Decoder (num_workers),
+# je CT2_INTRA Threads (cpu_threads). Mehr als 8 Threads bringen meist nur Cache-Thrashing
+CT2_INTER = int(os.environ.get("CT2_INTER", "1"))
+CT2_INTRA = int(os.environ.get("CT2_INTRA", str(min(8, os.cpu_count() or 4))))
+if DEVICE == "cpu":
+    # Gleiche Begrenzung für das PyTorch-Alignment
+    torch.set_num_threads(CT2_INTRA)
 LANGUAGE = "de"
 
-# Format-Hinweis für bessere Transkription (immer im initial_prompt enthalten)
-FORMAT_PROMPT = "Klammern (so wie diese) und Satzzeichen wie Punkt, Komma, Doppelpunkt und Semikolon sind wichtig."
+# Unterhalb dieser Dauer (Sekunden) wird im Turbo-Modus auf VAD verzichtet
+TURBO_VAD_MIN_DURATION = 5.0
+# Bis zu dieser Dauer (ein Encoder-Fenster) darf der Turbo-Modus ohne Zeitstempel-Token dekodieren
+TURBO_NO_TIMESTAMPS_MAX_DURATION = 30.0
+# Im Präzisions-Modus erst unter 2s (kürzer als das sinnvolle Fenster des VAD-Modells)
+PRECISION_VAD_MIN_DURATION = 2.0
+
+# Ab dieser Dauer (Sekunden) nutzt der Präzisions-Modus die Batch-Pipeline,
+# darunter sequentielles Faster-Whisper mit VAD
+PRECISION_BATCH_MIN_DURATION = 60.0
+
+# Sprach-Fixture für /warmup (optional, sonst Rauschen)
+WARMUP_AUDIO = os.environ.get("WARMUP_AUDIO", os.path.join(os.path.dirname(os.path.abspath(__file__)), "warmup.wav"))
+
+# Anzahl gecachter Transkriptionsergebnisse (LRU, 0 deaktiviert)
+RESULT_CACHE_SIZE = int(os.environ.get("RESULT_CACHE_SIZE", "256"))
+
+# Blocklänge (Sekunden) für die überlappende Dekodierung in /transcribe-stream
+STREAM_CHUNK_SECONDS = 30
+# Segmente, die in den letzten Sekunden eines Blocks enden, können an der Blockgrenze
+# abgeschnitten sein; sie werden verworfen und zusammen mit dem nächsten Block neu dekodiert
+STREAM_TAIL_SECONDS = 5.0
+
+# Micro-Batching: kurze Turbo-Requests, die innerhalb des Fensters eintreffen,
+# werden gemeinsam durch Encoder/Decoder geschickt (opt-in, liefert nur ein Segment pro Clip)
+MICRO_BATCH = os.environ.get("MICRO_BATCH", "false").lower() == "true"
+MICRO_BATCH_WINDOW = int(os.environ.get("MICRO_BATCH_WINDOW_MS", "20")) / 1000  # Sekunden
+MICRO_BATCH_MAX_SIZE = int(os.environ.get("MICRO_BATCH_MAX_SIZE", "16"))
+MICRO_BATCH_MAX_DURATION = 30.0  # Sekunden, ein Encoder-Fenster
+
+# Maximale Anzahl gleichzeitig gecachter Alignment-Modelle (LRU)
+MAX_ALIGN_MODELS = 3
+
+# Alignment über ONNX Runtime statt PyTorch (opt-in, nur wenn onnxruntime installiert ist)
+ALIGN_ONNX = os.environ.get("ALIGN_ONNX", "false").lower() == "true" and onnxruntime is not None
+ALIGN_ONNX_DIR = os.environ.get("ALIGN_ONNX_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "onnx"))
+
+# Format-Hinweis für bessere Transkription (immer im initial_prompt enthalten).
+# Whisper imitiert den Stil des Prompts, daher kurz und mit den gewünschten Satzzeichen als Beispiel;
+# jedes Prompt-Token kostet pro Decode-Schritt einen KV-Cache-Slot.
+FORMAT_PROMPT = os.environ.get("FORMAT_PROMPT", "Satzzeichen (Klammern): Punkt, Komma; Semikolon.")
 
-# Globaler Cache für Modelle (einmal laden, immer nutzen)
-MODEL_CACHE = {
-    "whisperx": None,       # WhisperX Batch-Modell
-    "faster_whisper": None, # Natives Faster-Whisper für Turbo-Modus
-    "align_model": None,    # Alignment-Modell
-    "align_metadata": None, # Alignment-Metadaten
-    "is_warmed_up": False   # Warmup-Status
-}
+@dataclass
+class Models:
+    """Geladene Modelle (einmal laden, immer nutzen). Einzige Quelle für Modell-Referenzen."""
+    whisperx: object = None  # WhisperX Batch-Modell
+    fw: object = None        # Natives Faster-Whisper für Turbo-Modus
+    batched: object = None   # Batched Faster-Whisper Pipeline für Präzisions-Modus
+    align: OrderedDict = field(default_factory=OrderedDict)  # language -> (model, metadata)
+    ready: bool = False      # Warmup-Status
+
+# Globaler Modell-Zustand
+STATE = Models()
+
+# Serialisiert das Nachladen von Alignment-Modellen
+ALIGN_LOCK = threading.Lock()
+
+# Serialisiert load_models()/Restart, damit nie zwei Whisper-Kopien gleichzeitig im VRAM liegen
+# (RLock, da restart_whisper_models() load_models() unter dem Lock aufruft)
+LOAD_LOCK = threading.RLock()
+
+# Die WhisperX-Pipeline hält den initial_prompt in ihren Optionen (siehe _iter_transcription)
+WHISPERX_LOCK = threading.Lock()
+
+# Ergebnis-Cache für identische Uploads (Frontend-Retries, Doppelklick): key -> Response-Payload
+RESULT_CACHE = OrderedDict()
+RESULT_CACHE_LOCK = threading.Lock()
 
 def print_vram_usage(step_name):
     """Überwacht VRAM-Nutzung für Debugging."""
@@ -137,54 +272,197 @@ def print_vram_usage(step_name):
         reserved = torch.cuda.memory_reserved() / 1024**2
         logger.info(f"[{step_name}] VRAM: {allocated:.2f} MB allocated, {reserved:.2f} MB reserved")
 
+class OrtAlignModel:
+    """
+    Ersatz für das HuggingFace-wav2vec2-Alignment-Modell auf Basis von ONNX Runtime.
+    whisperx.align ruft mit preprocess=True (Standard) model(**processor(...)).logits auf,
+    sonst model(waveform).logits; die CTC-Nachbearbeitung bleibt bei WhisperX.
+    """
+    
+    def __init__(self, session):
+        self.session = session
+        self.input_name = session.get_inputs()[0].name
+    
+    def __call__(self, waveform=None, input_values=None, attention_mask=None):
+        # attention_mask wird ignoriert: whisperx aligned jedes Segment einzeln (Batch 1,
+        # ohne Padding), die Maske besteht also nur aus Einsen
+        if input_values is None:
+            input_values = waveform
+        logits = self.session.run(None, {self.input_name: input_values.cpu().numpy()})[0]
+        return _OrtAlignOutput(torch.from_numpy(logits))
+
+
+class _OrtAlignOutput:
+    def __init__(self, logits):
+        self.logits = logits
+
+
+def _load_ort_aligner(lang, model_a, metadata):
+    """
+    Exportiert ein HuggingFace-Alignment-Modell einmalig nach ONNX und lädt es in ONNX Runtime.
+    Gibt None zurück, wenn das Modell nicht exportierbar ist (z.B. torchaudio-Pipelines).
+    """
+    if metadata.get("type") != "huggingface":
+        return None
+    
+    onnx_path = os.path.join(ALIGN_ONNX_DIR, f"align-{lang}.onnx")
+    if not os.path.exists(onnx_path):
+        logger.info(f"Exporting alignment model for '{lang}' to {onnx_path}...")
+        os.makedirs(ALIGN_ONNX_DIR, exist_ok=True)
+        dummy_input = torch.zeros(1, 16000, dtype=torch.float32, device=DEVICE)
+        with torch.no_grad():
+            torch.onnx.export(
+                model_a,
+                (dummy_input,),
+                onnx_path,
+                input_names=["input_values"],
+                output_names=["logits"],
+                dynamic_axes={
+                    "input_values": {0: "batch", 1: "samples"},
+                    "logits": {0: "batch", 1: "frames"}
+                },
+                opset_version=17
+            )
+    
+    providers = ["CUDAExecutionProvider", "CPUExecutionProvider"] if DEVICE == "cuda" else ["CPUExecutionProvider"]
+    session = onnxruntime.InferenceSession(onnx_path, providers=providers)
+    logger.info(f"Alignment model for '{lang}' running on ONNX Runtime ({session.get_providers()[0]})")
+    return OrtAlignModel(session)
+
+
+def get_aligner(lang):
+    """
+    Liefert (model, metadata) des Alignment-Modells für eine Sprache.
+    Lädt bei Cache-Miss nach; ältestes Modell wird ab MAX_ALIGN_MODELS verdrängt.
+    Gibt None zurück, wenn für die Sprache kein Alignment-Modell verfügbar ist.
+    Gleichzeitige Requests laden dasselbe Modell nur einmal (ALIGN_LOCK).
+    """
+    with ALIGN_LOCK:
+        return _get_aligner_locked(lang)
+
+def _get_aligner_locked(lang):
+    cache = STATE.align
+    
+    if lang in cache:
+        cache.move_to_end(lang)
+        return cache[lang]
+    
+    try:
+        logger.info(f"Loading alignment model for '{lang}'...")
+        model_a, metadata = whisperx.load_align_model(language_code=lang, device=DEVICE)
+        model_a.eval()
+        aligner = (model_a, metadata)
+        if ALIGN_ONNX:
+            try:
+                ort_model = _load_ort_aligner(lang, model_a, metadata)
+                if ort_model is not None:
+                    # PyTorch-Gewichte nicht weiter vorhalten
+                    aligner = (ort_model, metadata)
+            except Exception as e:
+                logger.warning(f"ONNX alignment for '{lang}' unavailable, using PyTorch: {e}")
+        logger.info(f"Alignment model for '{lang}' loaded and cached")
+    except Exception as e:
+        # Auch Fehlschläge cachen, damit nicht jeder Request erneut lädt
+        logger.warning(f"Could not load alignment model for '{lang}': {e}")
+        aligner = None
+    
+    cache[lang] = aligner
+    while len(cache) > MAX_ALIGN_MODELS:
+        # Kein empty_cache(): der Allocator verwendet den freien Speicher wieder
+        evicted, _ = cache.popitem(last=False)
+        logger.info(f"Evicted alignment model for '{evicted}'")
+    
+    return aligner
+
+@functools.lru_cache(maxsize=128)
+def encode_prompt(prompt: str) -> tuple:
+    """
+    Tokenisiert einen initial_prompt einmalig (wie faster-whisper intern) und cached die Token-IDs.
+    Der Standard-Prompt und gängige Wörterbuch-Varianten werden so nicht bei jedem Request neu encodiert.
+    """
+    return tuple(STATE.fw.hf_tokenizer.encode(" " + prompt.strip(), add_special_tokens=False).ids)
+
+
+def build_initial_prompt(user_prompt: str) -> str:
+    """Baut den initial_prompt aus Format-Hinweis und optionalem Nutzer-Prompt."""
+    if user_prompt:
+        return f"{FORMAT_PROMPT} {user_prompt}"
+    return FORMAT_PROMPT
+
+
 def load_models():
-    """Lädt alle Modelle beim Start für minimale Latenz."""
-    global MODEL_CACHE
+    """Lädt alle Modelle beim Start für minimale Latenz.
     
+    Idempotent: sind die Modelle bereits geladen (z.B. bei erneutem Import durch einen
+    Reloader oder parallelen /warmup-Requests), passiert nichts.
+    """
+    with LOAD_LOCK:
+        if STATE.ready:
+            return
+        _load_models_locked()
+
+def _load_models_locked():
+    """
+    Lädt die Modelle in ein neues Models-Objekt und ersetzt STATE erst danach.
+    Aufrufer hält LOAD_LOCK.
+    """
+    global STATE
+    models = Models()
     print_vram_usage("BEFORE_LOAD")
     
     # WhisperX Modell laden (für Präzisions-Modus)
     logger.info(f"Loading WhisperX model {MODEL_NAME} on {DEVICE}...")
-    MODEL_CACHE["whisperx"] = whisperx.load_model(
+    ct2_model = None
+    if DEVICE == "cpu":
+        # whisperx.load_model reicht num_workers nicht durch, daher CT2-Modell selbst bauen
+        logger.info(f"CPU threads: inter={CT2_INTER}, intra={CT2_INTRA}")
+        ct2_model = whisperx.asr.WhisperModel(
+            MODEL_NAME, device=DEVICE,
+            compute_type=COMPUTE_TYPE,
+            cpu_threads=CT2_INTRA,
+            num_workers=CT2_INTER
+        )
+    models.whisperx = whisperx.load_model(
         MODEL_NAME, DEVICE, 
         compute_type=COMPUTE_TYPE, 
-        language=LANGUAGE
+        language=LANGUAGE,
+        asr_options={"initial_prompt": FORMAT_PROMPT},
+        model=ct2_model
     )
     logger.info("WhisperX model loaded successfully")
     
     # Natives Faster-Whisper Modell extrahieren (für Turbo-Modus)
     # WhisperX wrappt intern ein faster-whisper Modell
-    if hasattr(MODEL_CACHE["whisperx"], 'model'):
-        MODEL_CACHE["faster_whisper"] = MODEL_CACHE["whisperx"].model
+    if hasattr(models.whisperx, 'model'):
+        models.fw = models.whisperx.model
         logger.info("Faster-Whisper core extracted for turbo mode")
     else:
-        MODEL_CACHE["faster_whisper"] = MODEL_CACHE["whisperx"]
+        models.fw = models.whisperx
         logger.info("Using WhisperX model directly for turbo mode")
     
+    # Batched Pipeline über dem Faster-Whisper-Kern (optional, für Präzisions-Modus)
+    if BatchedInferencePipeline is not None:
+        models.batched = BatchedInferencePipeline(model=models.fw)
+        logger.info("Batched inference pipeline ready for precision mode")
+    else:
+        models.batched = None
+        logger.info("BatchedInferencePipeline not available, using WhisperX batch pipeline")
+    
     print_vram_usage("AFTER_WHISPER")
     
-    # Alignment-Modell (optional, für Präzisions-Modus)
-    try:
-        MODEL_CACHE["align_model"], MODEL_CACHE["align_metadata"] = whisperx.load_align_model(
-            language_code=LANGUAGE, device=DEVICE
-        )
-        logger.info("Alignment model loaded and cached")
-    except Exception as e:
-        logger.warning(f"Could not load alignment model: {e}")
-        MODEL_CACHE["align_model"] = None
-        MODEL_CACHE["align_metadata"] = None
+    # Alignment-Modelle werden erst beim ersten Präzisions-Request geladen (get_aligner),
+    # reine Turbo-Deployments sparen so den wav2vec2-VRAM
     
-    print_vram_usage("AFTER_ALIGN")
-    MODEL_CACHE["is_warmed_up"] = True
+    models.ready = True
+    STATE = models
+    
+    # Token-Cache erst leeren, wenn der neue Tokenizer aktiv ist; Standard-Prompt vorab tokenisieren
+    encode_prompt.cache_clear()
+    encode_prompt(FORMAT_PROMPT)
 
 # Modelle beim Start laden
 load_models()
 
-# Aliase für Kompatibilität
-model = MODEL_CACHE["whisperx"]
-model_a = MODEL_CACHE["align_model"]
-metadata = MODEL_CACHE["align_metadata"]
-
 
 @app.route('/health', methods=['GET'])
 def health():
@@ -200,9 +478,10 @@ def health():
         'device': DEVICE,
         'model': MODEL_NAME,
         'language': LANGUAGE,
-        'warmed_up': MODEL_CACHE.get("is_warmed_up", False),
-        'turbo_available': MODEL_CACHE.get("faster_whisper") is not None,
-        'align_available': MODEL_CACHE.get("align_model") is not None,
+        'warmed_up': STATE.ready,
+        'turbo_available': STATE.fw is not None,
+        'align_available': STATE.align.get(LANGUAGE) is not None,
+        'align_languages': [lang for lang, aligner in STATE.align.items() if aligner is not None],
         'vram': vram_info,
         'retry_count': len(RETRY_LOG)
     })
@@ -266,42 +545,86 @@ def retry_logs_endpoint():
 def warmup():
     """
     Warmup-Endpoint für Frontend-Initialisierung.
-    Führt eine Mini-Transkription durch, um alle CUDA-Kernel vorzuladen.
+    Durchläuft Turbo-, Präzisions- und Alignment-Pfad mit 30s Audio, um alle
+    CUDA-Kernel und cuBLAS-Algorithmen für die Produktions-Shapes vorzuladen.
     """
     try:
         start_time = time.time()
         
-        if not MODEL_CACHE.get("is_warmed_up"):
+        if not STATE.ready:
             load_models()
         
-        # Generiere 1 Sekunde Stille für Warmup
-        import numpy as np
-        silent_audio = np.zeros(16000, dtype=np.float32)  # 1s @ 16kHz
+        # Echte Sprache (WARMUP_AUDIO), damit der Decoder genug Schritte für alle
+        # Attention-Shapes durchläuft; ohne Fixture 30s leises Rauschen, das zumindest
+        # Encoder- und wav2vec2-Shapes echter Requests trifft. VAD würde Rauschen komplett
+        # verwerfen (dann liefen weder Encoder noch Decoder), daher dort ohne VAD
+        has_speech = os.path.exists(WARMUP_AUDIO)
+        if has_speech:
+            with open(WARMUP_AUDIO, 'rb') as f:
+                warmup_audio, _ = load_audio_bytes(f.read())
+        else:
+            logger.info(f"No warmup fixture at {WARMUP_AUDIO}, using noise without VAD")
+            warmup_audio = np.random.randn(16000 * 30).astype(np.float32) * 0.01
         
-        # Warmup mit Turbo-Modus (schnellster Pfad)
-        fw_model = MODEL_CACHE.get("faster_whisper")
-        if fw_model:
-            logger.info("Warming up Faster-Whisper core...")
-            # Transkribiere Stille um CUDA-Kernel zu laden
-            segments, _ = fw_model.transcribe(
-                silent_audio,
+        # Turbo-Modus und kurze Präzisions-Clips (beide Beam-Größen der Produktion)
+        for beam_size in (1, 5):
+            logger.info(f"Warming up Faster-Whisper core (beam_size={beam_size})...")
+            segments, _ = STATE.fw.transcribe(
+                warmup_audio,
                 language=LANGUAGE,
-                beam_size=1,
-                best_of=1,
-                vad_filter=False,  # Bei Stille kein VAD
+                beam_size=beam_size,
+                best_of=beam_size,
+                vad_filter=has_speech,
                 word_timestamps=False
             )
-            # Konsumiere Generator um Ausführung zu triggern
             list(segments)
         
+        # Präzisions-Modus (Batch-Pipeline, beide Batch-Größen)
+        for batch_size in (8, 16):
+            logger.info(f"Warming up precision batch pipeline (batch_size={batch_size})...")
+            if STATE.batched is not None:
+                if has_speech:
+                    segments, _ = STATE.batched.transcribe(warmup_audio, batch_size=batch_size, language=LANGUAGE)
+                else:
+                    # Ohne VAD: dasselbe 30s-Fenster batch_size-mal als volle Batch
+                    segments, _ = STATE.batched.transcribe(
+                        warmup_audio,
+                        batch_size=batch_size,
+                        language=LANGUAGE,
+                        vad_filter=False,
+                        clip_timestamps=[{"start": 0, "end": len(warmup_audio)}] * batch_size
+                    )
+                list(segments)
+            elif has_speech:
+                STATE.whisperx.transcribe(warmup_audio, batch_size=batch_size, language=LANGUAGE)
+            else:
+                # transcribe() filtert immer per pyannote-VAD; die Pipeline direkt aufrufen
+                # (wie transcribe() intern), um Encoder und Decoder mit voller Batch zu treffen
+                list(STATE.whisperx(
+                    ({"inputs": warmup_audio} for _ in range(batch_size)),
+                    batch_size=batch_size,
+                    num_workers=0
+                ))
+        
+        # Alignment nur, wenn bereits geladen (Lazy-Load erst durch Präzisions-Requests).
+        # Auf Rauschen entstehen kaum Segmente, daher ein festes über das ganze Fenster.
+        aligner = STATE.align.get(LANGUAGE)
+        if aligner is not None:
+            logger.info("Warming up alignment model...")
+            model_a, metadata = aligner
+            with torch.inference_mode():
+                whisperx.align(
+                    [{"text": "warmup", "start": 0.0, "end": 30.0}],
+                    model_a,
+                    metadata,
+                    warmup_audio,
+                    "cpu" if isinstance(model_a, OrtAlignModel) else DEVICE,
+                    return_char_alignments=False
+                )
+        
         warmup_time = time.time() - start_time
         logger.info(f"Warmup completed in {warmup_time:.2f}s")
         
-        # VRAM nach Warmup freigeben
-        gc.collect()
-        if DEVICE == "cuda":
-            torch.cuda.empty_cache()
-        
         return jsonify({
             'status': 'warmed_up',
             'warmup_time': warmup_time,
@@ -323,8 +646,11 @@ def transcribe():
     Transkribiert Audio mit WhisperX
     
     Mit automatischem Retry bei Fehlern:
-    - VRAM wird vor jedem Diktat gelöscht (30s warten)
-    - Bei Fehler: VRAM löschen, Whisper neu starten, 60s warten, erneut versuchen
+    - VRAM wird vor dem Diktat nur bei Speicherdruck gelöscht
+    - Bei GPU-Fehler (OOM/CUDA): VRAM löschen und erneut versuchen
+      (exponentieller Backoff, maximal 10s)
+    - Whisper wird nur bei Treiberfehlern oder vor dem letzten Versuch neu geladen
+    - Andere Fehler (z.B. ungültige Datei) schlagen sofort fehl
     - Maximal 3 Versuche
     
     Erwartet:
@@ -334,12 +660,14 @@ def transcribe():
     - language: Sprache (Standard: de)
     - align: Alignment aktivieren (Standard: true)
     - speed_mode: "turbo" für minimale Latenz, "precision" für Wort-Zeitstempel
+    - stream: "true" für NDJSON-Antwort (ein Segment pro Zeile, zuletzt {"_final": true, ...}),
+      ohne Retry
+    - timestamps: "true" für Segment-Zeitstempel im Turbo-Modus (Standard: false)
     """
-    # VRAM vor dem Diktat löschen
-    logger.info("[PRE-TRANSCRIBE] Clearing VRAM before dictation...")
-    clear_vram()
-    logger.info(f"[PRE-TRANSCRIBE] Waiting {VRAM_CLEAR_WAIT}s after VRAM clear...")
-    time.sleep(VRAM_CLEAR_WAIT)
+    request_start = time.time()
+    
+    # VRAM nur bei Speicherdruck löschen (empty_cache ist synchron, kein Warten nötig)
+    clear_vram_if_needed()
     
     # Datei-Daten für Retry speichern
     if 'file' not in request.files:
@@ -359,6 +687,22 @@ def transcribe():
     do_align = request.form.get('align', 'true').lower() == 'true'
     speed_mode = request.form.get('speed_mode', 'auto')
     user_prompt = request.form.get('initial_prompt', '')
+    timestamps = request.form.get('timestamps', 'false').lower() == 'true'
+    
+    if request.form.get('stream', 'false').lower() == 'true':
+        return _stream_transcription(file_content, file_filename, language, do_align, speed_mode, user_prompt, timestamps)
+    
+    cache_key = _result_cache_key(file_content, language, do_align, speed_mode, user_prompt, timestamps)
+    cached = _result_cache_get(cache_key)
+    if cached is not None:
+        logger.info(f"[CACHE] Hit for {file_filename}, skipping transcription")
+        # Laufzeit und Versuche des Original-Requests gelten nicht für die Wiederholung
+        return jsonify({
+            **cached,
+            'duration': time.time() - request_start,
+            'attempt': 0,
+            'cached': True
+        })
     
     last_error = None
     
@@ -371,28 +715,44 @@ def transcribe():
                 do_align, 
                 speed_mode, 
                 user_prompt,
+                timestamps,
                 attempt
             )
-            return result
+            _result_cache_put(cache_key, result)
+            return jsonify(result)
             
         except Exception as e:
             last_error = str(e)
             logger.error(f"[TRANSCRIBE] Attempt {attempt}/{MAX_RETRIES} failed: {last_error}", exc_info=True)
             log_retry_attempt(attempt, last_error, "transcription_failed")
             
+            if not is_transient_gpu_error(e):
+                # Kein GPU-Zustandsproblem: Retry würde nur Zeit kosten
+                log_retry_attempt(attempt, last_error, "not_retryable")
+                return jsonify({
+                    'error': 'Transcription failed',
+                    'message': last_error,
+                    'attempts': attempt
+                }), 500
+            
             if attempt < MAX_RETRIES:
-                # VRAM löschen und Whisper neu starten
-                logger.info(f"[RETRY] Clearing VRAM and restarting Whisper...")
+                # Meist reicht es, den Allocator-Cache zu leeren; Neuladen nur bei
+                # Treiberfehlern oder vor dem letzten Versuch
+                needs_full_reload = is_driver_fault(e) or attempt + 1 >= MAX_RETRIES
+                
+                logger.info(f"[RETRY] Clearing VRAM...")
                 log_retry_attempt(attempt, last_error, "clearing_vram")
                 clear_vram()
                 
-                logger.info(f"[RETRY] Restarting Whisper models...")
-                log_retry_attempt(attempt, last_error, "restarting_whisper")
-                restart_whisper_models()
+                if needs_full_reload:
+                    logger.info(f"[RETRY] Restarting Whisper models...")
+                    log_retry_attempt(attempt, last_error, "restarting_whisper")
+                    restart_whisper_models()
                 
-                logger.info(f"[RETRY] Waiting {RETRY_WAIT_AFTER_ERROR}s before retry...")
-                log_retry_attempt(attempt, last_error, f"waiting_{RETRY_WAIT_AFTER_ERROR}s")
-                time.sleep(RETRY_WAIT_AFTER_ERROR)
+                wait = min(2 ** attempt, RETRY_MAX_WAIT)
+                logger.info(f"[RETRY] Waiting {wait}s before retry...")
+                log_retry_attempt(attempt, last_error, f"waiting_{wait}s")
+                time.sleep(wait)
     
     # Alle Versuche fehlgeschlagen
     logger.error(f"[TRANSCRIBE] All {MAX_RETRIES} attempts failed. Last error: {last_error}")
@@ -404,20 +764,438 @@ def transcribe():
     }), 500
 
 
-def _do_transcription(file_content: bytes, filename: str, language: str, do_align: bool, speed_mode: str, user_prompt: str, attempt: int):
+def _result_cache_key(file_content: bytes, language: str, do_align: bool, speed_mode: str, user_prompt: str, timestamps: bool) -> str:
+    """Cache-Key aus Audio-Hash und allen ergebnisrelevanten Parametern."""
+    audio_hash = hashlib.blake2b(file_content, digest_size=16).hexdigest()
+    prompt_hash = hashlib.blake2b(user_prompt.encode("utf-8"), digest_size=8).hexdigest()
+    return f"{audio_hash}:{language}:{speed_mode}:{do_align}:{timestamps}:{prompt_hash}"
+
+
+def _result_cache_get(key: str):
+    if RESULT_CACHE_SIZE <= 0:
+        return None
+    with RESULT_CACHE_LOCK:
+        if key not in RESULT_CACHE:
+            return None
+        RESULT_CACHE.move_to_end(key)
+        return RESULT_CACHE[key]
+
+
+def _result_cache_put(key: str, result: dict):
+    if RESULT_CACHE_SIZE <= 0:
+        return
+    with RESULT_CACHE_LOCK:
+        RESULT_CACHE[key] = result
+        RESULT_CACHE.move_to_end(key)
+        while len(RESULT_CACHE) > RESULT_CACHE_SIZE:
+            RESULT_CACHE.popitem(last=False)
+
+
+def _ffmpeg_pcm_cmd(sr: int):
+    """ffmpeg-Aufruf: beliebiges Format von stdin -> 16-bit Mono-PCM auf stdout."""
+    return [
+        "ffmpeg", "-nostdin", "-threads", "0",
+        # Nur Fehler auf stderr, sonst kann die ungelesene Pipe volllaufen
+        "-loglevel", "error", "-nostats",
+        "-i", "pipe:0",
+        "-f", "s16le", "-ac", "1", "-acodec", "pcm_s16le", "-ar", str(sr),
+        "pipe:1"
+    ]
+
+
+def decode_audio_bytes(data: bytes, sr: int = 16000) -> np.ndarray:
     """
-    Interne Transkriptions-Funktion für Retry-Logik.
+    Dekodiert Audio über eine ffmpeg-Pipe (stdin -> stdout) ohne Temp-File.
+    Entspricht whisperx.load_audio, liest aber aus dem Speicher.
     """
-    start_time = time.time()
+    try:
+        out = subprocess.run(_ffmpeg_pcm_cmd(sr), input=data, capture_output=True, check=True).stdout
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(f"Failed to load audio: {e.stderr.decode()}") from e
+    return np.frombuffer(out, np.int16).astype(np.float32) / 32768.0
+
+
+def iter_audio_chunks(data: bytes, chunk_seconds: int = 30, sr: int = 16000):
+    """
+    Dekodiert Audio über ffmpeg und liefert es in Blöcken von chunk_seconds als float32-Arrays.
     
-    # Initial Prompt zusammenbauen
-    if user_prompt:
-        initial_prompt = f"{FORMAT_PROMPT} {user_prompt}"
+    Ein Reader-Thread liest ffmpeg-Ausgabe im Voraus (bis zu zwei Blöcke), sodass die
+    Dekodierung des nächsten Blocks parallel zur Inferenz auf dem aktuellen läuft.
+    """
+    chunk_bytes = chunk_seconds * sr * 2
+    proc = subprocess.Popen(
+        _ffmpeg_pcm_cmd(sr),
+        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    )
+    chunks = queue.Queue(maxsize=2)
+    stop = threading.Event()
+    
+    def write_input():
+        try:
+            proc.stdin.write(data)
+            proc.stdin.close()
+        except (BrokenPipeError, OSError):
+            pass
+    
+    def put(item):
+        while not stop.is_set():
+            try:
+                chunks.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                continue
+    
+    def read_output():
+        while not stop.is_set():
+            buf = proc.stdout.read(chunk_bytes)
+            if not buf:
+                break
+            buf = buf[:len(buf) - len(buf) % 2]
+            put(np.frombuffer(buf, np.int16).astype(np.float32) / 32768.0)
+        if proc.wait() != 0 and not stop.is_set():
+            put(RuntimeError(f"Failed to load audio: {proc.stderr.read().decode()}"))
+        put(None)
+    
+    threading.Thread(target=write_input, daemon=True).start()
+    threading.Thread(target=read_output, daemon=True).start()
+    
+    try:
+        while True:
+            item = chunks.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+    finally:
+        # Bei Abbruch (z.B. Client getrennt) ffmpeg und Reader beenden
+        stop.set()
+        if proc.poll() is None:
+            proc.kill()
+
+
+def parse_pcm16_wav(data: bytes, sr: int = 16000):
+    """
+    Liest 16-bit Mono-PCM-WAVs mit passender Samplerate direkt ohne Decoder.
+    Gibt None zurück, wenn die Datei ein anderes Format hat.
+    """
+    if len(data) < 12 or data[:4] != b"RIFF" or data[8:12] != b"WAVE":
+        return None
+    
+    fmt_ok = False
+    pos = 12
+    while pos + 8 <= len(data):
+        chunk_id = data[pos:pos + 4]
+        chunk_size = struct.unpack_from("<I", data, pos + 4)[0]
+        body = pos + 8
+        if chunk_id == b"fmt ":
+            # Abgeschnittener Header: PyAV/ffmpeg entscheiden lassen
+            if chunk_size < 16 or body + 16 > len(data):
+                return None
+            audio_format, channels, sample_rate = struct.unpack_from("<HHI", data, body)
+            bits_per_sample = struct.unpack_from("<H", data, body + 14)[0]
+            fmt_ok = audio_format == 1 and channels == 1 and sample_rate == sr and bits_per_sample == 16
+            if not fmt_ok:
+                return None
+        elif chunk_id == b"data":
+            if not fmt_ok:
+                return None
+            # Browser-Recorder schreiben beim Streaming teils 0/0xFFFFFFFF als Größe
+            end = min(body + chunk_size, len(data)) if chunk_size else len(data)
+            end -= (end - body) % 2
+            return np.frombuffer(data, dtype=np.int16, count=(end - body) // 2, offset=body).astype(np.float32) * (1.0 / 32768.0)
+        # Chunks sind auf gerade Länge gepaddet
+        pos = body + chunk_size + (chunk_size % 2)
+    return None
+
+
+def load_audio_bytes(file_content: bytes):
+    """
+    Dekodiert Audio direkt aus dem Speicher: 16 kHz Mono-PCM-WAV ohne Decoder,
+    sonst PyAV im Prozess, ffmpeg-Pipe als Fallback.
+    Gibt (audio, audio_duration) zurück.
+    """
+    logger.info("Loading audio...")
+    audio = parse_pcm16_wav(file_content)
+    if audio is not None:
+        logger.info("16 kHz mono PCM WAV, skipping decoder")
     else:
-        initial_prompt = FORMAT_PROMPT
+        try:
+            audio = decode_audio(io.BytesIO(file_content), sampling_rate=16000)
+        except Exception as e:
+            # PyAV-Wheels bringen eigene Codecs mit; für Exoten den System-ffmpeg nutzen
+            logger.warning(f"PyAV decode failed ({e}), falling back to ffmpeg pipe")
+            audio = decode_audio_bytes(file_content)
+    audio_duration = len(audio) / 16000
+    logger.info(f"Audio loaded: {audio_duration:.1f}s")
+    return audio, audio_duration
+
+
+def segment_to_dict(seg) -> dict:
+    """
+    Wandelt ein faster-whisper-Segment in ein schlankes Dict (text/start/end, ggf. words).
+    Statt _asdict(): Felder wie tokens, avg_logprob oder no_speech_prob nutzt kein Client.
+    """
+    seg_dict = {"text": seg.text, "start": seg.start, "end": seg.end}
+    if seg.words:
+        seg_dict["words"] = [{"word": w.word, "start": w.start, "end": w.end} for w in seg.words]
+    return seg_dict
+
+
+def _turbo_transcribe(audio, audio_duration: float, language: str, initial_prompt: str, timestamps: bool = True):
+    """
+    Startet die Turbo-Transkription mit dem nativen Faster-Whisper-Kern.
+    Gibt (segments_generator, info) zurück; Segmente werden erst beim Iterieren dekodiert.
+    
+    Ohne timestamps dekodiert Whisper bei Clips bis 30s keine Zeitstempel-Token; das Segment
+    umfasst dann den ganzen Clip. Längere Clips behalten sie, da Faster-Whisper das Fenster
+    sonst starr um 30s weiterschiebt und an jeder Grenze Wörter abschneidet.
+    """
+    fw_model = STATE.fw
+    
+    # Kurze Diktate: Silero-VAD kostet mehr als es an Decode-Zeit spart
+    use_vad = audio_duration > TURBO_VAD_MIN_DURATION
+    without_timestamps = not timestamps and audio_duration <= TURBO_NO_TIMESTAMPS_MAX_DURATION
+    
+    return fw_model.transcribe(
+        audio,
+        language=language,
+        initial_prompt=list(encode_prompt(initial_prompt)),
+        beam_size=1,
+        best_of=1,
+        temperature=0,
+        condition_on_previous_text=False,
+        vad_filter=use_vad,
+        word_timestamps=False,
+        without_timestamps=without_timestamps
+    )
+
+
+class MicroBatcher:
+    """
+    Sammelt kurze Turbo-Requests, die innerhalb von MICRO_BATCH_WINDOW eintreffen, und
+    dekodiert sie in einem gemeinsamen CTranslate2 encode/generate-Aufruf.
+    
+    Jeder Clip passt in ein 30s-Encoder-Fenster, daher genügt Padding auf die volle
+    Mel-Länge. Ergebnis ist der reine Text ohne Zeitstempel.
+    """
+    
+    def __init__(self, window: float, max_size: int):
+        self.window = window
+        self.max_size = max_size
+        self.queue = queue.Queue()
+        self.tokenizers = {}
+        self.thread = None
+        self.lock = threading.Lock()
+    
+    def submit(self, audio, language: str, initial_prompt: str) -> Future:
+        """Reiht einen Clip ein; das Future liefert den transkribierten Text."""
+        self._ensure_worker()
+        future = Future()
+        self.queue.put((audio, language, initial_prompt, future))
+        return future
     
-    # Auto-Modus: Turbo für kurze Clips (Online), Precision für längere (Offline)
-    is_turbo = speed_mode == 'turbo' or (speed_mode == 'auto' and 'turbo' in MODEL_NAME.lower())
+    def _ensure_worker(self):
+        # Lazy starten: ein beim Import gestarteter Thread überlebt einen Fork (z.B. gunicorn --preload) nicht
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self._run, name="micro-batcher", daemon=True)
+                self.thread.start()
+    
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+            while len(batch) < self.max_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            
+            try:
+                texts = self._transcribe_batch(batch)
+                for (_, _, _, future), text in zip(batch, texts):
+                    future.set_result(text)
+            except Exception as e:
+                logger.error(f"[MICRO-BATCH] Batch of {len(batch)} failed: {e}", exc_info=True)
+                for _, _, _, future in batch:
+                    future.set_exception(e)
+    
+    def _get_tokenizer(self, fw_model, language: str):
+        if language not in self.tokenizers:
+            self.tokenizers[language] = Tokenizer(
+                fw_model.hf_tokenizer,
+                fw_model.model.is_multilingual,
+                task="transcribe",
+                language=language
+            )
+        return self.tokenizers[language]
+    
+    def _transcribe_batch(self, batch):
+        fw_model = STATE.fw
+        n_frames = fw_model.feature_extractor.nb_max_frames
+        
+        features = []
+        prompts = []
+        for audio, language, initial_prompt, _ in batch:
+            mel = fw_model.feature_extractor(audio)[:, :n_frames]
+            features.append(np.pad(mel, ((0, 0), (0, n_frames - mel.shape[-1]))))
+            
+            tokenizer = self._get_tokenizer(fw_model, language)
+            previous_tokens = list(encode_prompt(initial_prompt)) if initial_prompt else []
+            prompts.append(fw_model.get_prompt(tokenizer, previous_tokens, without_timestamps=True))
+        
+        logger.info(f"[MICRO-BATCH] Decoding {len(batch)} clip(s) in one batch")
+        encoder_output = fw_model.model.encode(
+            ctranslate2.StorageView.from_array(np.ascontiguousarray(np.stack(features), dtype=np.float32))
+        )
+        results = fw_model.model.generate(encoder_output, prompts, beam_size=1, max_length=fw_model.max_length)
+        
+        texts = []
+        for (_, language, _, _), result in zip(batch, results):
+            tokenizer = self._get_tokenizer(fw_model, language)
+            tokens = [token for token in result.sequences_ids[0] if token < tokenizer.eot]
+            texts.append(tokenizer.decode(tokens).strip())
+        return texts
+
+
+MICRO_BATCHER = MicroBatcher(MICRO_BATCH_WINDOW, MICRO_BATCH_MAX_SIZE)
+
+
+def _is_turbo(speed_mode: str) -> bool:
+    """Auto-Modus: Turbo für kurze Clips (Online), Precision für längere (Offline)."""
+    return speed_mode == 'turbo' or (speed_mode == 'auto' and 'turbo' in MODEL_NAME.lower())
+
+
+def _iter_transcription(audio, audio_duration: float, language: str, do_align: bool, is_turbo: bool, initial_prompt: str, timestamps: bool = True):
+    """
+    Transkribiert und liefert Segment-Dicts, sobald sie feststehen: im Turbo-Modus direkt
+    aus dem Decoder, im Präzisions-Modus nach dem Alignment.
+    Letztes Element ist immer {"_final": True, "language": ...}.
+    """
+    if is_turbo and MICRO_BATCH and audio_duration <= MICRO_BATCH_MAX_DURATION:
+        # ⚡ TURBO-MODUS (Micro-Batch mit gleichzeitigen Requests)
+        logger.info("⚡ TURBO: Queuing for micro-batch...")
+        
+        text = MICRO_BATCHER.submit(audio, language, initial_prompt).result()
+        yield {"text": text, "start": 0.0, "end": audio_duration}
+        yield {"_final": True, "language": language}
+        return
+    
+    if is_turbo:
+        # ⚡ TURBO-MODUS
+        logger.info("⚡ TURBO: Using native Faster-Whisper core...")
+        
+        segments_gen, info = _turbo_transcribe(audio, audio_duration, language, initial_prompt, timestamps)
+        for seg in segments_gen:
+            yield segment_to_dict(seg)
+        yield {"_final": True, "language": info.language}
+        return
+    
+    # 🎯 PRÄZISIONS-MODUS
+    batched = STATE.batched
+    
+    if audio_duration < PRECISION_BATCH_MIN_DURATION:
+        # Kurze Clips: sequentiell mit Silero-VAD, Batching lohnt erst bei vielen Chunks
+        logger.info("🎯 PRECISION: Using native Faster-Whisper core (short clip)...")
+        
+        # Push-to-Talk-Kommandos: VAD-Pass wäre teurer als die Inferenz, kaum Stille-Padding;
+        # ohne Kontext aus vorherigen Fenstern kein Halluzinations-Drift
+        is_short = audio_duration < PRECISION_VAD_MIN_DURATION
+        
+        segments_gen, info = STATE.fw.transcribe(
+            audio,
+            language=language,
+            initial_prompt=list(encode_prompt(initial_prompt)),
+            beam_size=5,
+            best_of=5,
+            # Temperatur-Fallback verhindert Wiederholungsschleifen
+            temperature=(0.0, 0.2, 0.4, 0.6, 0.8, 1.0),
+            condition_on_previous_text=not is_short,
+            vad_filter=not is_short,
+            word_timestamps=False
+        )
+        
+        # Alignment erwartet eine Liste von Dicts mit text/start/end
+        segments = [segment_to_dict(seg) for seg in segments_gen]
+        detected_language = info.language
+    elif batched is not None:
+        logger.info("🎯 PRECISION: Using batched Faster-Whisper pipeline...")
+        
+        segments_gen, info = batched.transcribe(
+            audio,
+            batch_size=16,
+            language=language,
+            # Batched-Pipeline tokenisiert den Prompt selbst und akzeptiert nur Strings
+            initial_prompt=initial_prompt,
+            vad_filter=True
+        )
+        
+        # Alignment erwartet eine Liste von Dicts mit text/start/end
+        segments = [segment_to_dict(seg) for seg in segments_gen]
+        detected_language = info.language
+    else:
+        logger.info("🎯 PRECISION: Using WhisperX batch pipeline...")
+        
+        # FasterWhisperPipeline.transcribe kennt keinen initial_prompt; er steckt in den
+        # beim Laden gesetzten asr_options und wird pro Request unter Lock getauscht
+        pipeline = STATE.whisperx
+        with WHISPERX_LOCK:
+            default_options = pipeline.options
+            pipeline.options = default_options._replace(initial_prompt=initial_prompt)
+            try:
+                result = pipeline.transcribe(
+                    audio, 
+                    batch_size=16, 
+                    language=language
+                )
+            finally:
+                pipeline.options = default_options
+        
+        segments = result["segments"]
+        detected_language = result.get("language", language)
+    
+    aligner = get_aligner(language) if do_align else None
+    
+    if aligner is not None:
+        model_a, metadata = aligner
+        logger.info("Running alignment for word timestamps...")
+        if isinstance(model_a, OrtAlignModel):
+            # ONNX Runtime übernimmt die Kopie auf die GPU selbst
+            align_audio, align_device = audio, "cpu"
+        else:
+            # whisperx.align schneidet pro Segment aus dem Tensor und kopiert auf die GPU;
+            # aus Pinned Memory läuft diese H2D-Kopie ohne Staging-Buffer
+            align_audio = torch.from_numpy(audio).pin_memory() if DEVICE == "cuda" else audio
+            align_device = DEVICE
+        # inference_mode statt no_grad: auch keine Version-Counter/View-Tracking-Kosten
+        with torch.inference_mode():
+            result = whisperx.align(
+                segments, 
+                model_a, 
+                metadata, 
+                align_audio, 
+                align_device,
+                return_char_alignments=False
+            )
+        segments = result["segments"]
+    
+    yield from segments
+    yield {"_final": True, "language": detected_language}
+
+
+def _do_transcription(file_content: bytes, filename: str, language: str, do_align: bool, speed_mode: str, user_prompt: str, timestamps: bool, attempt: int):
+    """
+    Interne Transkriptions-Funktion für Retry-Logik.
+    Gibt den Response-Payload als Dict zurück.
+    """
+    start_time = time.time()
+    
+    initial_prompt = build_initial_prompt(user_prompt)
+    is_turbo = _is_turbo(speed_mode)
     
     mode_str = "TURBO ⚡" if is_turbo else "PRECISION 🎯"
     logger.info(f"[{mode_str}] Transcribing (attempt {attempt}): {filename}, language: {language}")
@@ -426,94 +1204,179 @@ def _do_transcription(file_content: bytes, filename: str, language: str, do_alig
     
     print_vram_usage("BEFORE_TRANSCRIBE")
     
-    # Temporäre Datei erstellen
-    suffix = Path(filename).suffix if filename else '.wav'
-    with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as tmp_file:
-        tmp_file.write(file_content)
-        tmp_path = tmp_file.name
+    audio, audio_duration = load_audio_bytes(file_content)
     
-    try:
-        # Audio laden
-        logger.info("Loading audio...")
-        audio = whisperx.load_audio(tmp_path)
-        audio_duration = len(audio) / 16000
-        logger.info(f"Audio loaded: {audio_duration:.1f}s")
-        
-        if is_turbo:
-            # ⚡ TURBO-MODUS
-            logger.info("⚡ TURBO: Using native Faster-Whisper core...")
-            
-            fw_model = MODEL_CACHE.get("faster_whisper", model)
-            
-            segments_gen, info = fw_model.transcribe(
-                audio,
-                language=language,
-                initial_prompt=initial_prompt,
-                beam_size=1,
-                best_of=1,
-                vad_filter=True,
-                word_timestamps=False
-            )
-            
-            segments = [seg._asdict() for seg in segments_gen]
-            detected_language = info.language
-            
-            logger.info(f"⚡ TURBO complete: {len(segments)} segments")
-            
+    # Segmente und Text in einem Durchlauf sammeln
+    segments = []
+    text_parts = []
+    detected_language = language
+    for item in _iter_transcription(audio, audio_duration, language, do_align, is_turbo, initial_prompt, timestamps):
+        if item.get("_final"):
+            detected_language = item["language"]
         else:
-            # 🎯 PRÄZISIONS-MODUS
-            logger.info("🎯 PRECISION: Using WhisperX batch pipeline...")
-            
-            batch_size = 8 if audio_duration < 60 else 16
-            
-            result = model.transcribe(
-                audio, 
-                batch_size=batch_size, 
-                language=language, 
-                initial_prompt=initial_prompt
-            )
-            
-            segments = result["segments"]
-            detected_language = result.get("language", language)
-            
-            if do_align and model_a is not None:
-                logger.info("Running alignment for word timestamps...")
-                with torch.no_grad():
-                    result = whisperx.align(
-                        segments, 
-                        model_a, 
-                        metadata, 
-                        audio, 
-                        DEVICE,
-                        return_char_alignments=False
-                    )
-                segments = result["segments"]
-            
-            logger.info(f"🎯 PRECISION complete: {len(segments)} segments")
-        
-        full_text = " ".join([seg.get("text", "") for seg in segments])
+            segments.append(item)
+            if item.get("text"):
+                text_parts.append(item["text"])
+    full_text = " ".join(text_parts)
+    
+    logger.info(f"[{mode_str}] complete: {len(segments)} segments")
+    
+    transcription_time = time.time() - start_time
+    logger.info(f"✓ Transcription done in {transcription_time:.2f}s | Mode: {mode_str} | Attempt: {attempt}")
+    print_vram_usage("AFTER_TRANSCRIBE")
+    
+    return {
+        'text': full_text.strip(),
+        'segments': segments,
+        'language': detected_language,
+        'mode': 'turbo' if is_turbo else 'precision',
+        'duration': transcription_time,
+        'attempt': attempt
+    }
+
+
+def _stream_transcription(file_content: bytes, filename: str, language: str, do_align: bool, speed_mode: str, user_prompt: str, timestamps: bool):
+    """
+    Streamende Variante von _do_transcription: ein NDJSON-Segment pro Zeile, zum Schluss
+    {"_final": true, ...}. Ohne Retry, da nach dem ersten Byte kein Statuscode mehr änderbar ist.
+    """
+    start_time = time.time()
+    
+    initial_prompt = build_initial_prompt(user_prompt)
+    is_turbo = _is_turbo(speed_mode)
+    mode = 'turbo' if is_turbo else 'precision'
+    logger.info(f"[STREAM {mode.upper()}] Transcribing: {filename}, language: {language}")
+    
+    try:
+        audio, audio_duration = load_audio_bytes(file_content)
+    except Exception as e:
+        logger.error(f"[STREAM] Transcription failed: {e}", exc_info=True)
+        return jsonify({
+            'error': 'Transcription failed',
+            'message': str(e)
+        }), 500
+    
+    def generate():
+        try:
+            for item in _iter_transcription(audio, audio_duration, language, do_align, is_turbo, initial_prompt, timestamps):
+                if item.get("_final"):
+                    item = {**item, 'mode': mode, 'duration': time.time() - start_time}
+                yield json.dumps(item) + "\n"
+        except Exception as e:
+            logger.error(f"[STREAM] Error while streaming: {e}", exc_info=True)
+            yield json.dumps({'error': str(e)}) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+@app.route('/transcribe-stream', methods=['POST'])
+def transcribe_stream():
+    """
+    Transkribiert Audio im Turbo-Modus und streamt die Segmente als NDJSON.
+    
+    Das Audio wird in 30s-Blöcken dekodiert; während ein Block transkribiert wird,
+    dekodiert ffmpeg bereits den nächsten. Segmente nahe dem Blockende werden erst mit dem
+    folgenden Block ausgegeben, damit an den Grenzen keine Wörter abgeschnitten werden.
+    Zeitstempel beziehen sich auf die ganze Datei.
+    
+    Jede Zeile ist ein JSON-Objekt mit einem Segment, sobald es dekodiert ist.
+    Die letzte Zeile enthält Metadaten: {"_final": true, "language": ..., "duration": ...}.
+    Tritt während des Streamings ein Fehler auf, folgt stattdessen {"error": ...}.
+    
+    Erwartet:
+    - file: Audio-Datei (multipart/form-data)
+    
+    Optional:
+    - language: Sprache (Standard: de)
+    - initial_prompt: Zusätzlicher Prompt (z.B. Wörterbuch-Wörter)
+    """
+    if 'file' not in request.files:
+        return jsonify({'error': 'No file provided'}), 400
+    
+    file = request.files['file']
+    if file.filename == '':
+        return jsonify({'error': 'Empty filename'}), 400
+    
+    language = request.form.get('language', LANGUAGE)
+    initial_prompt = build_initial_prompt(request.form.get('initial_prompt', ''))
+    
+    start_time = time.time()
+    logger.info(f"[STREAM ⚡] Transcribing: {file.filename}, language: {language}")
+    
+    chunks = iter_audio_chunks(file.read(), chunk_seconds=STREAM_CHUNK_SECONDS)
+    try:
+        # Ersten Block vorab holen, damit Dekodierfehler noch als HTTP-Fehler gemeldet werden
+        first_chunk = next(chunks, None)
+        if first_chunk is None:
+            raise RuntimeError("No audio decoded")
+    except Exception as e:
+        logger.error(f"[STREAM] Transcription failed: {e}", exc_info=True)
+        return jsonify({
+            'error': 'Transcription failed',
+            'message': str(e)
+        }), 500
+    
+    def all_chunks():
+        yield first_chunk
+        yield from chunks
+    
+    def generate():
+        count = 0
+        detected_language = language
+        # Noch nicht ausgegebenes Audio (Rest des vorherigen Blocks + aktueller Block)
+        buffer = np.zeros(0, dtype=np.float32)
+        buffer_offset = 0.0
+        try:
+            blocks = all_chunks()
+            next_chunk = next(blocks, None)
+            while next_chunk is not None:
+                buffer = np.concatenate([buffer, next_chunk])
+                next_chunk = next(blocks, None)
+                buffer_duration = len(buffer) / 16000
+                # Letzter Block oder Rest ohne Segmentgrenze: alles ausgeben
+                is_last = next_chunk is None or buffer_duration >= 2 * STREAM_CHUNK_SECONDS
+                cutoff = buffer_duration if is_last else buffer_duration - STREAM_TAIL_SECONDS
+                
+                # Zeitstempel bleiben an: Schnittpunkt und Offsets setzen sie voraus
+                segments_gen, info = _turbo_transcribe(buffer, buffer_duration, language, initial_prompt, timestamps=True)
+                detected_language = info.language
+                carry_from = None
+                for seg in segments_gen:
+                    if not is_last and seg.end > cutoff:
+                        # Ab hier mit dem nächsten Block neu dekodieren
+                        carry_from = seg.start
+                        break
+                    count += 1
+                    seg_dict = segment_to_dict(seg)
+                    seg_dict["start"] += buffer_offset
+                    seg_dict["end"] += buffer_offset
+                    yield json.dumps(seg_dict) + "\n"
+                
+                if carry_from is None:
+                    # Alles bis zum Schnittpunkt ausgegeben (oder nur Stille)
+                    carry_from = cutoff
+                keep = int(carry_from * 16000)
+                buffer = buffer[keep:]
+                buffer_offset += keep / 16000
+        except Exception as e:
+            logger.error(f"[STREAM] Error while streaming: {e}", exc_info=True)
+            yield json.dumps({'error': str(e)}) + "\n"
+            return
         
         transcription_time = time.time() - start_time
-        logger.info(f"✓ Transcription done in {transcription_time:.2f}s | Mode: {mode_str} | Attempt: {attempt}")
-        print_vram_usage("AFTER_TRANSCRIBE")
-        
-        return jsonify({
-            'text': full_text.strip(),
-            'segments': segments,
+        logger.info(f"✓ Stream done in {transcription_time:.2f}s | {count} segments")
+        yield json.dumps({
+            '_final': True,
             'language': detected_language,
-            'mode': 'turbo' if is_turbo else 'precision',
-            'duration': transcription_time,
-            'attempt': attempt
-        })
-        
-    finally:
-        if os.path.exists(tmp_path):
-            os.unlink(tmp_path)
-        gc.collect()
-        if DEVICE == "cuda":
-            torch.cuda.empty_cache()
+            'mode': 'turbo',
+            'duration': transcription_time
+        }) + "\n"
+    
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
 
 
+# Produktion: gunicorn -c gunicorn.conf.py app:app (ein gthread-Worker, mehrere Threads)
+# Der Flask-Dev-Server bleibt für die lokale Entwicklung.
 if __name__ == '__main__':
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
@@ -0,0 +1,30 @@
+"""
+gunicorn-Konfiguration für den WhisperX-Service.
+
+Start: gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Ein Worker: jeder weitere hielte eine eigene Modellkopie im VRAM.
+# Parallele Requests laufen über Threads; CTranslate2 gibt während der Inferenz
+# den GIL frei, sodass ffmpeg/Upload und GPU-Arbeit überlappen.
+workers = 1
+worker_class = "gthread"
+threads = int(os.environ.get("GUNICORN_THREADS", "8"))
+
+# Kein preload_app: würden die Modelle im Master geladen, erbte der Worker per Fork
+# einen initialisierten CUDA-Kontext, der im Kindprozess nicht nutzbar ist.
+# Mit nur einem Worker bringt Preload ohnehin keine geteilten Seiten.
+preload_app = False
+
+# Lange Präzisions-Diktate inkl. Retries brauchen mehr als die üblichen 30s
+timeout = 600
+
+
+def on_starting(server):
+    """Bricht ab, wenn Preload doch aktiviert wurde (z.B. --preload oder GUNICORN_CMD_ARGS)."""
+    if server.cfg.preload_app:
+        raise RuntimeError("preload_app is not supported: CUDA cannot be initialized before fork")